@@ -1,11 +1,32 @@
+import hmac
 import json
 import logging
 import os
+import random
+import signal
+import threading
 import time
-from typing import Tuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlencode
 
 import urllib3
-from urllib3.filepost import encode_multipart_formdata
+from urllib3.filepost import choose_boundary
+
+# orjson parses bytes directly and is several times faster than the stdlib;
+# fall back to json when it isn't installed (e.g. code pasted into the console)
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
 
 # Configure logging to see output in CloudWatch
 logging.basicConfig(level=logging.INFO)
@@ -14,122 +35,436 @@ logger = logging.getLogger(__name__)
 # Best practice: load secrets and config from environment variables
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "<API-KEY-HERE>")
 SONIOX_TOKEN = os.environ.get("SONIOX_TOKEN", "<API-KEY-HERE>")
-ALLOW_LIST = os.environ.get("ALLOW_LIST", "delgod").split(",")
-
-# Initialize a single PoolManager for connection pooling
-http = urllib3.PoolManager()
+ALLOW_LIST = frozenset(
+    name.strip()
+    for name in os.environ.get("ALLOW_LIST", "delgod").split(",")
+    if name.strip()
+)
+
+# Initialize a single PoolManager for connection pooling. It lives at module
+# scope so warm Lambda invocations reuse its sockets. Each host keeps up to 10
+# warm connections so concurrent requests (e.g. cleanup) don't have to open
+# fresh TLS sessions. Retries are done by request_with_retry, not urllib3.
+http = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=10,
+    block=False,
+    timeout=urllib3.Timeout(connect=2.0, read=30.0),
+    retries=False,
+)
 soniox_headers = {"Authorization": f"Bearer {SONIOX_TOKEN}"}
-
-# Constants for retry logic and message truncation
-MAX_POLL_RETRIES = 24
-POLL_RETRY_DELAY_S = 0.5
+soniox_json_headers = {**soniox_headers, "Content-Type": "application/json"}
+
+# API endpoints, built once at load time; "{}" placeholders take resource ids
+SONIOX_FILES_URL = "https://api.soniox.com/v1/files"
+SONIOX_FILE_URL_FMT = SONIOX_FILES_URL + "/{}"
+SONIOX_TRANSCRIPTIONS_URL = "https://api.soniox.com/v1/transcriptions"
+SONIOX_TRANSCRIPTION_URL_FMT = SONIOX_TRANSCRIPTIONS_URL + "/{}"
+SONIOX_TRANSCRIPT_URL_FMT = SONIOX_TRANSCRIPTION_URL_FMT + "/transcript"
+TELEGRAM_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+TELEGRAM_GETFILE_URL_FMT = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getFile?file_id={{}}"
+TELEGRAM_FILE_URL_FMT = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{{}}"
+# Telegram download paths stay valid for at least an hour; cached lookups
+# are bucketed by this many seconds so stale paths age out
+FILE_PATH_TTL_S = 1800
+
+# Optional DynamoDB cache of transcripts, keyed by Telegram file_unique_id
+CACHE_TABLE = os.environ.get("CACHE_TABLE")
+CACHE_TTL_S = 30 * 24 * 3600
+cache_table = None  # Created on first use, see get_cache_table()
+
+# Optional SQS queue: when set, the webhook only enqueues media messages and
+# worker_handler (subscribed to the queue) does the transcription
+QUEUE_URL = os.environ.get("QUEUE_URL")
+sqs_client = None  # Created on first use, see get_sqs_client()
+
+# Optional Soniox completion webhook: when both are set, transcriptions are
+# not polled; Soniox calls this function's URL back with the secret header
+COMPLETION_WEBHOOK_URL = os.environ.get("COMPLETION_WEBHOOK_URL")
+SONIOX_WEBHOOK_SECRET = os.environ.get("SONIOX_WEBHOOK_SECRET")
+WEBHOOK_AUTH_HEADER = "X-Webhook-Secret"
+
+# Shared worker pool for overlapping independent HTTP calls (e.g. cleanup).
+# Like the connection pool, it lives for the whole container so warm
+# invocations reuse its threads; it is never shut down explicitly.
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="stt")
+# Cleanup jobs still running in the background; see wait_for_cleanup()
+pending_cleanups: List[Future] = []
+# Set when the runtime is shutting down; wakes any poll sleep immediately
+stop_event = threading.Event()
+
+
+def handle_sigterm(signum, frame) -> None:
+    """Cancels in-flight polling when Lambda sends SIGTERM before shutdown."""
+    logger.warning("Received SIGTERM, cancelling in-flight work")
+    stop_event.set()
+
+
+# Only inside Lambda: locally (and in tests) Ctrl+C/SIGTERM keep their defaults
+if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+# Constants for retry logic and message truncation. Polling backs off
+# exponentially (0.3s, 0.45s, ... capped at 5s) and gives up after
+# POLL_TIMEOUT_S of wall-clock time; MAX_POLL_RETRIES is only a safety bound.
+POLL_TIMEOUT_S = 20.0
+MAX_POLL_RETRIES = 12
+POLL_INITIAL_DELAY_S = 0.3
+POLL_MAX_DELAY_S = 5.0
+POLL_BACKOFF_FACTOR = 1.5
+POLL_JITTER = 0.1
+# Each status request must finish within the remaining poll time, but gets at
+# least this long so the last poll isn't doomed to time out
+POLL_MIN_REQUEST_TIMEOUT_S = 1.0
 MAX_ERROR_LEN = 100
+# Failures of an HTTP exchange itself (connection, TLS, timeout, protocol);
+# anything else is a bug and should surface in lambda_handler's logs
+REQUEST_ERRORS = (urllib3.exceptions.HTTPError, OSError)
+# Transient failures are retried with full-jitter exponential backoff: attempt
+# n waits uniform(0, RETRY_BASE_DELAY_S * 2**n), capped to fit in a Lambda run
+MAX_REQUEST_RETRIES = 3
+RETRY_BASE_DELAY_S = 0.25
+RETRY_MAX_DELAY_S = 5.0
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+# Other methods (uploads, sendMessage) may already have taken effect after a
+# read timeout or a 5xx from a gateway, so they are only retried when the
+# connection was refused or the server rejected them with Retry-After codes
+IDEMPOTENT_METHODS = frozenset({"GET", "DELETE"})
+UNSENT_RETRY_STATUSES = frozenset({429, 503})
+UNSENT_ERRORS = (urllib3.exceptions.ConnectTimeoutError,)  # incl. NewConnectionError
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Static part of the multipart file header; only the boundary and the
+# Content-Type vary per upload
+MULTIPART_DISPOSITION = (
+    b'\r\nContent-Disposition: form-data; name="file"; filename="file.dat"\r\n'
+    b"Content-Type: "
+)
+
+# Supported media message keys and their default MIME types, in order of
+# precedence. video_note has no mime_type field, so it is always mp4.
+MEDIA_TYPES = (
+    ("voice", "audio/ogg"),
+    ("video", "video/mp4"),
+    ("video_note", "video/mp4"),
+)
+
+# Pre-serialized "start transcription" request body; only the JSON-encoded
+# file_id (and optional webhook fields) are substituted per request
+TRANSCRIPTION_START_TMPL = (
+    b'{"file_id":%s,"model":"stt-async-preview","language_hints":["ru","uk","es","en"]%s}'
+)
+# sendMessage body; chat_id is an int, so only the text needs JSON escaping
+SEND_MESSAGE_TMPL = b'{"chat_id":%d,"text":%s}'
+
+
+def error_snippet(raw: bytes) -> str:
+    """Decodes only the first MAX_ERROR_LEN bytes of an error response body."""
+    return raw[:MAX_ERROR_LEN].decode("utf-8", errors="replace")
+
+
+def request_with_retry(
+    method: str, url: str, retries: Optional[int] = None, **kwargs
+) -> urllib3.HTTPResponse:
+    """Performs an HTTP request, retrying transient failures.
+
+    For GET and DELETE, network errors and RETRY_STATUSES responses
+    (throttling, server errors) are retried up to `retries` times (default
+    MAX_REQUEST_RETRIES), sleeping with full jitter in between so concurrent
+    clients don't retry in lockstep. Other methods are retried only on
+    UNSENT_ERRORS and UNSENT_RETRY_STATUSES, so an upload or reply is never
+    repeated. Other responses are returned immediately. After the last
+    attempt the final response is returned or the error re-raised.
+    """
+    if retries is None:
+        retries = MAX_REQUEST_RETRIES
+    if method in IDEMPOTENT_METHODS:
+        retry_statuses, retry_errors = RETRY_STATUSES, REQUEST_ERRORS
+    else:
+        retry_statuses, retry_errors = UNSENT_RETRY_STATUSES, UNSENT_ERRORS
+    # Telegram URLs embed the bot token, so only the host is ever logged
+    host = urllib3.util.parse_url(url).host
+    attempt = 0
+    while True:
+        try:
+            response = http.request(method, url, **kwargs)
+            if response.status not in retry_statuses or attempt >= retries:
+                return response
+            logger.warning(f"{method} {host} returned {response.status}, retrying")
+            response.drain_conn()
+        except REQUEST_ERRORS as e:
+            if attempt >= retries or not isinstance(e, retry_errors):
+                raise
+            logger.warning(f"{method} {host} failed ({type(e).__name__}), retrying")
+        time.sleep(min(random.uniform(0, RETRY_BASE_DELAY_S * 2**attempt), RETRY_MAX_DELAY_S))
+        attempt += 1
+
+
+def request_data(
+    method: str, url: str, retries: Optional[int] = None, **kwargs
+) -> Tuple[int, bytes]:
+    """Performs a request via `request_with_retry` and returns status and body.
+
+    The connection is always released back to the pool, even if reading the
+    body fails, so error bursts can't leak pooled sockets.
+    """
+    response = request_with_retry(method, url, retries, **kwargs)
+    try:
+        return response.status, response.data
+    finally:
+        response.release_conn()
 
 
 def send_reply(chat_id: int, message: str) -> bool:
     """Sends a reply message back to the user via the Telegram API."""
     logger.info(f"Sending reply to chat_id {chat_id}: '{message[:80]}...'")
     try:
-        reply_payload = {"chat_id": chat_id, "text": message}
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        encoded_payload = json.dumps(reply_payload).encode("utf-8")
-        response = http.request(
+        status, _ = request_data(
             "POST",
-            url,
-            body=encoded_payload,
+            TELEGRAM_SEND_URL,
+            body=SEND_MESSAGE_TMPL % (chat_id, json_dumps(message)),
             headers={"Content-Type": "application/json"},
         )
-        return response.status < 400
-    except Exception as e:
+        return status < 400
+    except REQUEST_ERRORS as e:
         logger.error(f"Failed to send reply to chat_id {chat_id}: {e}")
         return False
 
 
+def soniox_request(
+    method: str,
+    url: str,
+    body: Union[bytes, Iterable[bytes], None] = None,
+    headers: Dict[str, str] = soniox_headers,
+    retries: Optional[int] = None,
+    timeout: Optional[urllib3.Timeout] = None,
+) -> Tuple[int, Union[dict, str]]:
+    """Calls the Soniox API and returns the status with the parsed JSON body.
+
+    Never raises. Error responses return their status and a truncated body;
+    network and parsing failures return status 0 and the error text.
+    `retries` and `timeout` override the defaults of `request_with_retry`
+    and the connection pool.
+    """
+    try:
+        # A streamed body can only be sent once, so it is never retried
+        if isinstance(body, Iterator):
+            retries = 0
+        kwargs = {"timeout": timeout} if timeout is not None else {}
+        status, raw = request_data(method, url, retries, body=body, headers=headers, **kwargs)
+        if status >= 400:
+            return status, error_snippet(raw)
+        return status, json_loads(raw)
+    except (*REQUEST_ERRORS, ValueError) as e:
+        logger.error(f"Soniox {method} {url} failed: {e}")
+        return 0, str(e)
+
+
 def poll_until_complete(transcription_id: str) -> str:
     """Polls Soniox API until transcription is complete, fails, or times out."""
-    for _ in range(MAX_POLL_RETRIES):
-        try:
-            response = http.request(
-                "GET",
-                f"https://api.soniox.com/v1/transcriptions/{transcription_id}",
-                headers=soniox_headers,
-            )
-            if response.status >= 400:
-                logger.error(f"Polling failed with status {response.status}")
-                return "Error polling transcription status"
-
-            data = json.loads(response.data.decode("utf-8"))
-            status = data.get("status")
-
-            if status == "completed":
-                return "completed"
-            if status == "error":
-                error_message = data.get("error_message", "Unknown transcription error")
-                logger.error(f"Transcription failed: {error_message}")
-                return error_message
-        except urllib3.exceptions.MaxRetryError as e:
-            logger.error(f"Network error during polling: {e}")
-            return "Network error while polling transcription status"
-        except Exception as e:
-            logger.error(f"Unexpected error during polling: {e}")
-            return "Failed to get transcription status"
-        time.sleep(POLL_RETRY_DELAY_S)
-    return "Transcription timed out"
-
-
-def transcribe(file_content: bytes, file_type: str) -> str:
-    """Orchestrates the file upload, transcription, and cleanup process."""
-    file_id = None
-    transcription_id = None
-
+    deadline = time.monotonic() + POLL_TIMEOUT_S
+    remaining = POLL_TIMEOUT_S
+    delay = POLL_INITIAL_DELAY_S
+    result = "Transcription timed out"
+    for attempt in range(MAX_POLL_RETRIES):
+        # The loop itself polls again, so requests aren't retried, and each
+        # one is bounded by the time left so the deadline actually holds
+        status, data = soniox_request(
+            "GET",
+            SONIOX_TRANSCRIPTION_URL_FMT.format(transcription_id),
+            retries=0,
+            timeout=urllib3.Timeout(total=max(remaining, POLL_MIN_REQUEST_TIMEOUT_S)),
+        )
+        if not status or status in RETRY_STATUSES:
+            logger.warning(f"Polling attempt failed ({status or data}), will poll again")
+            result = "Failed to get transcription status"
+        elif status >= 400:
+            logger.error(f"Polling failed with status {status}")
+            return "Error polling transcription status"
+        elif data.get("status") == "completed":
+            return "completed"
+        elif data.get("status") == "error":
+            error_message = data.get("error_message", "Unknown transcription error")
+            logger.error(f"Transcription failed: {error_message}")
+            return error_message
+        else:
+            result = "Transcription timed out"
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or attempt == MAX_POLL_RETRIES - 1:
+            break
+        wait_s = min(delay + random.uniform(0, delay * POLL_JITTER), remaining)
+        if stop_event.wait(wait_s):
+            return "Transcription canceled"
+        remaining -= wait_s
+        delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY_S)
+    return result
+
+
+def delete_resource(url: str, description: str) -> None:
+    """Deletes a Soniox resource, logging (but not raising) any failure."""
     try:
-        # 1. Upload file to Soniox
-        try:
-            body, content_type = encode_multipart_formdata(
-                {"file": ("file.dat", file_content, file_type)}
+        request_data("DELETE", url, headers=soniox_headers)
+        logger.info(f"Deleted {description}")
+    except REQUEST_ERRORS as e:
+        logger.error(f"Failed to delete {description}: {e}")
+
+
+def stream_size(stream: BinaryIO) -> Optional[int]:
+    """Returns a streamed HTTP response's Content-Length, if it sent one.
+
+    Other readable streams have no known size, so None is returned.
+    """
+    length = getattr(stream, "headers", {}).get("Content-Length")
+    return int(length) if length is not None else None
+
+
+def encode_multipart_file(
+    file_content: Union[bytes, memoryview, BinaryIO], file_type: str
+) -> Tuple[Iterable[bytes], Dict[str, str]]:
+    """Builds a multipart/form-data body holding a single file field.
+
+    The body is returned as a sequence of chunks rather than one joined bytes
+    object, so the file content is never copied. Readable streams are consumed
+    lazily, one chunk at a time. When the size is known (see `stream_size`)
+    the body length is set up front; otherwise the upload falls back to
+    chunked transfer encoding.
+    """
+    boundary = choose_boundary()
+    boundary_bytes = boundary.encode("ascii")
+    head = b"".join(
+        (b"--", boundary_bytes, MULTIPART_DISPOSITION, file_type.encode("utf-8"), b"\r\n\r\n")
+    )
+    tail = b"".join((b"\r\n--", boundary_bytes, b"--\r\n"))
+
+    if isinstance(file_content, (bytes, memoryview)):
+        chunks: Iterable[bytes] = (head, file_content, tail)
+        file_size = len(file_content)
+    else:
+
+        def read_chunks() -> Iterator[bytes]:
+            yield head
+            yield from iter(partial(file_content.read, UPLOAD_CHUNK_SIZE), b"")
+            yield tail
+
+        chunks = read_chunks()
+        file_size = stream_size(file_content)
+
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    if file_size is not None:
+        headers["Content-Length"] = str(len(head) + file_size + len(tail))
+    return chunks, headers
+
+
+def wait_for_cleanup() -> None:
+    """Blocks until all background cleanup started by `transcribe` is done.
+
+    Lambda freezes the container as soon as the handler returns, so this must
+    be called before returning to make sure no Soniox resources are leaked.
+    """
+    cleanups = pending_cleanups[:]
+    del pending_cleanups[:]
+    wait(cleanups)
+
+
+def start_transcription(
+    file_content: Union[bytes, memoryview, BinaryIO],
+    file_type: str,
+    webhook_url: Optional[str] = None,
+) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Uploads the file to Soniox and starts its transcription.
+
+    Returns (file_id, transcription_id, error). The ids of any resources that
+    were created are returned even on error so they can be cleaned up. With a
+    `webhook_url`, Soniox calls it when the transcription finishes.
+    """
+    # 1. Upload file to Soniox
+    body, multipart_headers = encode_multipart_file(file_content, file_type)
+    status, data = soniox_request(
+        "POST", SONIOX_FILES_URL, body, {**soniox_headers, **multipart_headers}
+    )
+    if not status:
+        return None, None, f"File upload failed: {data}"
+    if status >= 400:
+        return None, None, f"File upload failed with status {status}: {data}"
+    file_id = data.get("id")
+    if not file_id:
+        return None, None, "Failed to get file_id from upload response"
+
+    # 2. Start transcription
+    webhook_fields = b""
+    if webhook_url:
+        webhook_fields = (
+            b',"webhook_url":%s,"webhook_auth_header_name":%s,"webhook_auth_header_value":%s'
+            % (
+                json_dumps(webhook_url),
+                json_dumps(WEBHOOK_AUTH_HEADER),
+                json_dumps(SONIOX_WEBHOOK_SECRET),
             )
-            upload_headers = soniox_headers.copy()
-            upload_headers["Content-Type"] = content_type
-            response = http.request(
-                "POST",
-                "https://api.soniox.com/v1/files",
-                body=body,
-                headers=upload_headers,
+        )
+    status, data = soniox_request(
+        "POST",
+        SONIOX_TRANSCRIPTIONS_URL,
+        TRANSCRIPTION_START_TMPL % (json_dumps(file_id), webhook_fields),
+        soniox_json_headers,
+    )
+    if not status:
+        return file_id, None, f"Transcription start failed: {data}"
+    if status >= 400:
+        return file_id, None, f"Transcription start failed with status {status}: {data}"
+    transcription_id = data.get("id")
+    if not transcription_id:
+        return file_id, None, "Failed to get transcription_id from response"
+    return file_id, transcription_id, None
+
+
+def get_transcript(transcription_id: str) -> str:
+    """Fetches the text of a completed transcription as a reply message."""
+    status, data = soniox_request("GET", SONIOX_TRANSCRIPT_URL_FMT.format(transcription_id))
+    if not status:
+        return f"Transcript retrieval failed: {data}"
+    if status >= 400:
+        return f"Transcript retrieval failed with status {status}: {data}"
+    transcript_text = data.get("text", "")
+    if not transcript_text:
+        return "Transcription completed but no text was found"
+    return f"Transcription: {transcript_text}"
+
+
+def cleanup_transcription(transcription_id: Optional[str], file_id: Optional[str]) -> None:
+    """Deletes the Soniox transcription and file in the background.
+
+    The two DELETEs are independent and run concurrently, so the caller can
+    reply to the user meanwhile (see wait_for_cleanup).
+    """
+    if transcription_id:
+        pending_cleanups.append(
+            executor.submit(
+                delete_resource,
+                SONIOX_TRANSCRIPTION_URL_FMT.format(transcription_id),
+                f"transcription {transcription_id}",
             )
-            if response.status >= 400:
-                err = response.data.decode("utf-8")[:MAX_ERROR_LEN]
-                return f"File upload failed with status {response.status}: {err}"
-            file_id = json.loads(response.data.decode("utf-8")).get("id")
-            if not file_id:
-                return "Failed to get file_id from upload response"
-        except (Exception, json.JSONDecodeError) as e:
-            logger.error(f"Error during file upload: {e}")
-            return f"File upload failed: {e}"
-
-        # 2. Start transcription
-        try:
-            transcription_data = {
-                "file_id": file_id,
-                "model": "stt-async-preview",
-                "language_hints": ["ru", "uk", "es", "en"],
-            }
-            json_headers = soniox_headers.copy()
-            json_headers["Content-Type"] = "application/json"
-            response = http.request(
-                "POST",
-                "https://api.soniox.com/v1/transcriptions",
-                body=json.dumps(transcription_data),
-                headers=json_headers,
+        )
+    if file_id:
+        pending_cleanups.append(
+            executor.submit(
+                delete_resource,
+                SONIOX_FILE_URL_FMT.format(file_id),
+                f"file {file_id}",
             )
-            if response.status >= 400:
-                err = response.data.decode("utf-8")[:MAX_ERROR_LEN]
-                return f"Transcription start failed with status {response.status}: {err}"
-            transcription_id = json.loads(response.data.decode("utf-8")).get("id")
-            if not transcription_id:
-                return "Failed to get transcription_id from response"
-        except (Exception, json.JSONDecodeError) as e:
-            logger.error(f"Error starting transcription: {e}")
-            return f"Transcription start failed: {e}"
+        )
+
+
+def transcribe(file_content: Union[bytes, memoryview, BinaryIO], file_type: str) -> str:
+    """Orchestrates the file upload, transcription, and cleanup process.
+
+    `file_content` may be the raw bytes, a memoryview (e.g. of a memory-mapped
+    file), or a readable stream (such as a streaming Telegram download); none
+    of them is copied or buffered whole.
+    """
+    file_id, transcription_id, error = start_transcription(file_content, file_type)
+    try:
+        if error:
+            return error
 
         # 3. Poll for result
         poll_result = poll_until_complete(transcription_id)
@@ -137,98 +472,238 @@ def transcribe(file_content: bytes, file_type: str) -> str:
             return f"Transcription failed: {poll_result}"
 
         # 4. Get transcript text
-        try:
-            response = http.request(
-                "GET",
-                f"https://api.soniox.com/v1/transcriptions/{transcription_id}/transcript",
-                headers=soniox_headers,
-            )
-            if response.status >= 400:
-                err = response.data.decode("utf-8")[:MAX_ERROR_LEN]
-                return f"Transcript retrieval failed with status {response.status}: {err}"
-            transcript_data = json.loads(response.data.decode("utf-8"))
-            transcript_text = transcript_data.get("text", "")
-
-            if not transcript_text:
-                return "Transcription completed but no text was found"
-
-            return f"Transcription: {transcript_text}"
-        except Exception as e:
-            logger.error(f"Error getting transcript text: {e}")
-            return f"Transcript retrieval failed: {e}"
-
+        return get_transcript(transcription_id)
     finally:
         # 5. Clean up resources regardless of success or failure
-        if transcription_id:
-            try:
-                http.request(
-                    "DELETE",
-                    f"https://api.soniox.com/v1/transcriptions/{transcription_id}",
-                    headers=soniox_headers,
-                )
-                logger.info(f"Deleted transcription {transcription_id}")
-            except Exception as e:
-                logger.error(f"Failed to delete transcription {transcription_id}: {e}")
-        if file_id:
-            try:
-                http.request(
-                    "DELETE",
-                    f"https://api.soniox.com/v1/files/{file_id}",
-                    headers=soniox_headers,
-                )
-                logger.info(f"Deleted file {file_id}")
-            except Exception as e:
-                logger.error(f"Failed to delete file {file_id}: {e}")
-
-
-def get_file(file_id: str) -> Tuple[int, Union[bytes, str]]:
-    """Gets file path from Telegram and downloads the file content."""
+        cleanup_transcription(transcription_id, file_id)
+
+
+def transcribe_with_callback(
+    file_content: Union[bytes, memoryview, BinaryIO],
+    file_type: str,
+    chat_id: int,
+    file_unique_id: Optional[str],
+) -> str:
+    """Starts a transcription whose result Soniox posts back to this function.
+
+    Nothing is polled: once Soniox calls COMPLETION_WEBHOOK_URL,
+    `handle_soniox_callback` fetches the transcript and sends it to the chat.
+    """
+    query = urlencode({"source": "soniox", "chat_id": chat_id, "fuid": file_unique_id or ""})
+    separator = "&" if "?" in COMPLETION_WEBHOOK_URL else "?"
+    file_id, transcription_id, error = start_transcription(
+        file_content, file_type, f"{COMPLETION_WEBHOOK_URL}{separator}{query}"
+    )
+    if error:
+        cleanup_transcription(transcription_id, file_id)
+        return error
+    return "Transcribing, the text will follow shortly."
+
+
+def handle_soniox_callback(event: dict) -> dict:
+    """Handles the Soniox completion webhook set up by `transcribe_with_callback`."""
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    secret = headers.get(WEBHOOK_AUTH_HEADER.lower(), "")
+    # compare_digest only accepts ASCII str, so compare the encoded bytes
+    if not SONIOX_WEBHOOK_SECRET or not hmac.compare_digest(
+        secret.encode("utf-8"), SONIOX_WEBHOOK_SECRET.encode("utf-8")
+    ):
+        logger.warning("Rejected Soniox callback with a missing or wrong secret")
+        return {"statusCode": 403, "body": "Forbidden"}
+
+    params = event.get("queryStringParameters") or {}
+    try:
+        body = json_loads(event.get("body", "{}"))
+        transcription_id = body["id"]
+        chat_id = int(params["chat_id"])
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error(f"Invalid Soniox callback: {e}")
+        return {"statusCode": 400, "body": "Invalid callback"}
+
+    # The transcription record holds the file id (for cleanup) and any error
+    status, data = soniox_request("GET", SONIOX_TRANSCRIPTION_URL_FMT.format(transcription_id))
+    details = data if 0 < status < 400 else {}
+    if body.get("status") == "completed":
+        reply_message = get_transcript(transcription_id)
+    else:
+        error_message = details.get("error_message", "Unknown transcription error")
+        reply_message = f"Transcription failed: {error_message}"
+
+    if reply_message.startswith("Transcription:"):
+        put_cached_transcript(params.get("fuid"), reply_message)
+    if not send_reply(chat_id, reply_message):
+        logger.warning("Failed to send reply message to user")
+    cleanup_transcription(transcription_id, details.get("file_id"))
+    return {"statusCode": 200, "body": "OK"}
+
+
+class FileLookupError(Exception):
+    """Raised when Telegram can't resolve a file_id to a download path."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+@lru_cache(maxsize=128)
+def get_file_path(file_id: str, ttl_bucket: int) -> str:
+    """Resolves a Telegram file_id to its download path via getFile.
+
+    Results are memoized per `ttl_bucket` (see FILE_PATH_TTL_S), so forwarded
+    or retried media skip the getFile round trip. Failures raise instead of
+    returning, so they are never cached.
+    """
+    status, raw = request_data("GET", TELEGRAM_GETFILE_URL_FMT.format(file_id))
+    if status >= 400:
+        raise FileLookupError(status, raw.decode("utf-8"))
+    remote_file_path = json_loads(raw).get("result", {}).get("file_path")
+    if not remote_file_path:
+        raise FileLookupError(404, "File path not found in Telegram response")
+    return remote_file_path
+
+
+def get_file(
+    file_id: str, stream: bool = False
+) -> Tuple[int, Union[bytes, str, urllib3.HTTPResponse]]:
+    """Gets file path from Telegram and downloads the file content.
+
+    With `stream=True`, a successful download is returned as an unread
+    response so the caller can pipe it onward; the caller must close it.
+    """
     try:
         # First, get the file path from the file_id
-        url1 = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getFile?file_id={file_id}"
-        response1 = http.request("GET", url1)
-        if response1.status >= 400:
-            return response1.status, response1.data.decode("utf-8")
-        data = json.loads(response1.data.decode("utf-8"))
-        remote_file_path = data.get("result", {}).get("file_path")
-        if not remote_file_path:
-            return 404, "File path not found in Telegram response"
+        try:
+            remote_file_path = get_file_path(file_id, int(time.monotonic() // FILE_PATH_TTL_S))
+        except FileLookupError as e:
+            return e.status, str(e)
 
         # Second, download the file from the path
-        url2 = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{remote_file_path}"
-        response2 = http.request("GET", url2)
-        return response2.status, response2.data
-    except (Exception, json.JSONDecodeError) as e:
+        url2 = TELEGRAM_FILE_URL_FMT.format(remote_file_path)
+        response2 = request_with_retry("GET", url2, preload_content=not stream)
+        if stream and response2.status == 200:
+            return response2.status, response2
+        try:
+            return response2.status, response2.data
+        finally:
+            response2.release_conn()
+    except (*REQUEST_ERRORS, ValueError) as e:
         logger.error(f"Exception in get_file: {e}")
         return 500, f"An error occurred while getting the file: {e}"
 
 
-def handle_media_message(message: dict) -> str:
-    """Generic handler for voice, video, and video_note messages."""
-    file_id = None
-    file_type = "application/octet-stream"  # Default MIME type
-
-    if "voice" in message:
-        file_id = message.get("voice", {}).get("file_id")
-        file_type = message.get("voice", {}).get("mime_type", "audio/ogg")
-    elif "video" in message:
-        file_id = message.get("video", {}).get("file_id")
-        file_type = message.get("video", {}).get("mime_type", "video/mp4")
-    elif "video_note" in message:
-        file_id = message.get("video_note", {}).get("file_id")
-        file_type = "video/mp4"  # video_note is always mp4
+def get_cache_table():
+    """Returns the DynamoDB transcript cache table, or None if caching is off.
+
+    boto3 takes hundreds of milliseconds to import, so it is only loaded once
+    a media message actually needs the cache, not on every cold start.
+    """
+    global cache_table
+    if cache_table is None and CACHE_TABLE:
+        import boto3  # Bundled with the AWS Lambda Python runtime
+
+        cache_table = boto3.resource("dynamodb").Table(CACHE_TABLE)
+    return cache_table
+
+
+def get_sqs_client():
+    """Returns the SQS client used to hand work to worker_handler."""
+    global sqs_client
+    if sqs_client is None:
+        import boto3  # Bundled with the AWS Lambda Python runtime
+
+        sqs_client = boto3.client("sqs")
+    return sqs_client
+
+
+def get_cached_transcript(file_unique_id: Optional[str]) -> Optional[str]:
+    """Returns a previously sent transcription reply, if one is cached."""
+    table = get_cache_table()
+    if table is None or not file_unique_id:
+        return None
+    try:
+        item = table.get_item(Key={"fid": file_unique_id}).get("Item")
+    except Exception as e:
+        logger.error(f"Failed to read transcript cache for {file_unique_id}: {e}")
+        return None
+    return item["text"] if item else None
+
+
+def put_cached_transcript(file_unique_id: Optional[str], text: str) -> None:
+    """Stores a transcription reply in the cache, if caching is enabled."""
+    table = get_cache_table()
+    if table is None or not file_unique_id:
+        return
+    try:
+        table.put_item(
+            Item={
+                "fid": file_unique_id,
+                "text": text,
+                "ttl": int(time.time()) + CACHE_TTL_S,
+            }
+        )
+    except Exception as e:
+        logger.error(f"Failed to write transcript cache for {file_unique_id}: {e}")
+
+
+def handle_media_message(message: dict) -> Optional[str]:
+    """Generic handler for voice, video, and video_note messages.
+
+    Returns the reply text, or None if the message carries no supported media.
+    """
+    for key, default_type in MEDIA_TYPES:
+        if key in message:
+            media = message[key] or {}
+            file_type = media.get("mime_type", default_type)
+            break
     else:
-        return "Unsupported message type."
+        return None
 
+    file_id = media.get("file_id")
     if not file_id:
         return "Could not find a file_id in the message."
 
-    response_code, file_content = get_file(file_id)
-    if response_code != 200 or not isinstance(file_content, bytes):
+    # file_unique_id is stable across forwards, unlike file_id
+    file_unique_id = media.get("file_unique_id")
+    cached = get_cached_transcript(file_unique_id)
+    if cached is not None:
+        logger.info(f"Transcript cache hit for {file_unique_id}")
+        return cached
+
+    # Stream the download straight into the Soniox upload
+    response_code, file_content = get_file(file_id, stream=True)
+    if response_code != 200 or isinstance(file_content, str):
         err = file_content if isinstance(file_content, str) else "Unknown error"
         return f"File download failed with code {response_code}: {err[:MAX_ERROR_LEN]}"
 
-    return transcribe(file_content, file_type)
+    try:
+        if COMPLETION_WEBHOOK_URL and SONIOX_WEBHOOK_SECRET:
+            result = transcribe_with_callback(
+                file_content, file_type, message["chat"]["id"], file_unique_id
+            )
+        else:
+            result = transcribe(file_content, file_type)
+    finally:
+        if not isinstance(file_content, bytes):
+            # A fully read download has already returned its connection to
+            # the pool; closing drops one left half-read by a failed upload
+            file_content.close()
+    if result.startswith("Transcription:"):
+        put_cached_transcript(file_unique_id, result)
+    return result
+
+
+def reply_to_message(message: dict) -> str:
+    """Builds the reply for an authorized message and sends it to its chat."""
+    reply_message = "Please send a voice, video, or video note for transcription."
+    if "text" in message:
+        reply_message = f"You sent text. {reply_message}"
+    else:
+        reply_message = handle_media_message(message) or reply_message
+
+    success = send_reply(message["chat"]["id"], reply_message)
+    if not success:
+        logger.warning("Failed to send reply message to user")
+    return reply_message
 
 
 def lambda_handler(event, _):
@@ -236,7 +711,10 @@ def lambda_handler(event, _):
     chat_id = None
     try:
         logger.info("Received event")
-        body = json.loads(event.get("body", "{}"))
+        if (event.get("queryStringParameters") or {}).get("source") == "soniox":
+            return handle_soniox_callback(event)
+
+        body = json_loads(event.get("body", "{}"))
         message = body.get("message")
 
         if not message:
@@ -254,17 +732,15 @@ def lambda_handler(event, _):
             send_reply(chat_id, f"Sorry, user '{username}' is not authorized.")
             return {"statusCode": 200, "body": f"{username} is unauthorized"}
 
-        reply_message = "Please send a voice, video, or video note for transcription."
-        if "text" in message:
-            reply_message = f"You sent text. {reply_message}"
-        elif any(k in message for k in ["voice", "video", "video_note"]):
-            reply_message = handle_media_message(message)
+        # Acknowledge Telegram right away and let the worker transcribe, so
+        # slow transcriptions never hold the webhook open
+        if QUEUE_URL and any(key in message for key, _ in MEDIA_TYPES):
+            get_sqs_client().send_message(QueueUrl=QUEUE_URL, MessageBody=event["body"])
+            logger.info(f"Queued message from chat_id {chat_id}")
+            return {"statusCode": 200, "body": "Queued for transcription"}
 
-        success = send_reply(chat_id, reply_message)
-        if not success:
-            logger.warning("Failed to send reply message to user")
-
-        return {"statusCode": 200, "body": json.dumps(reply_message)}
+        reply_message = reply_to_message(message)
+        return {"statusCode": 200, "body": json_dumps(reply_message).decode("utf-8")}
 
     except json.JSONDecodeError:
         logger.error("Received non-JSON event body")
@@ -274,3 +750,35 @@ def lambda_handler(event, _):
         if chat_id:
             send_reply(chat_id, "An unexpected error occurred. The administrator has been notified.")
         return {"statusCode": 500, "body": "Internal server error"}
+    finally:
+        # The reply has been sent; now let any Soniox cleanup finish
+        wait_for_cleanup()
+
+
+def process_queued_record(record: dict) -> None:
+    """Transcribes and answers one SQS record queued by `lambda_handler`.
+
+    Failures are reported to the user instead of raised, so SQS does not
+    redeliver (and re-transcribe) the message.
+    """
+    chat_id = None
+    try:
+        message = json_loads(record["body"])["message"]
+        chat_id = message["chat"]["id"]
+        reply_to_message(message)
+    except Exception as e:
+        logger.error(f"Failed to process queued message: {e}", exc_info=True)
+        if chat_id:
+            send_reply(chat_id, "An unexpected error occurred. The administrator has been notified.")
+
+
+def worker_handler(event, _):
+    """AWS Lambda entry point for the SQS queue fed by `lambda_handler`.
+
+    Messages were already authorized by the webhook. Records in a batch are
+    independent, so they are transcribed and answered concurrently.
+    """
+    try:
+        list(executor.map(process_queued_record, event.get("Records", [])))
+    finally:
+        wait_for_cleanup()
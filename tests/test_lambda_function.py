@@ -1,17 +1,45 @@
+import io
 import json
 import os
+import subprocess
+import sys
+import threading
 import unittest
 import importlib
-from unittest.mock import MagicMock, call, patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, PropertyMock, call, patch
+
+import urllib3
 
 import lambda_function as lf
 
 
 class TestLambdaFunction(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Patch environment variables and reload the module once for all tests."""
+        cls.username = "testuser"
+        cls.env_patcher = patch.dict(
+            os.environ,
+            {
+                "TELEGRAM_TOKEN": "fake_telegram_token",
+                "SONIOX_TOKEN": "fake_soniox_token",
+                "ALLOW_LIST": cls.username,
+            },
+        )
+        cls.env_patcher.start()
+        # Reload the module to ensure it picks up the patched environment variables
+        importlib.reload(lf)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Restore the environment and the module's default configuration."""
+        cls.env_patcher.stop()
+        importlib.reload(lf)
+
     def setUp(self):
-        """Set up common test data and mock environment variables."""
+        """Set up common test data."""
         self.chat_id = 12345
-        self.username = "testuser"
         self.file_id = "file_id_123"
         self.file_content = b"fake_audio_data"
         self.file_type = "audio/ogg"
@@ -19,19 +47,108 @@ class TestLambdaFunction(unittest.TestCase):
         self.soniox_file_id = "soniox_file_id_xyz"
         self.reply_message = "This is a reply."
 
-        # Patch environment variables
-        self.env_patcher = patch.dict(
-            os.environ,
-            {
-                "TELEGRAM_TOKEN": "fake_telegram_token",
-                "SONIOX_TOKEN": "fake_soniox_token",
-                "ALLOW_LIST": self.username,
-            },
-        )
-        self.env_patcher.start()
-        # Reload the module to ensure it picks up the patched environment variables
-        importlib.reload(lf)
-        self.addCleanup(self.env_patcher.stop)
+        # Most tests script a single response per call; retries get their own tests
+        retry_patcher = patch.object(lf, "MAX_REQUEST_RETRIES", 0)
+        retry_patcher.start()
+        self.addCleanup(retry_patcher.stop)
+        lf.get_file_path.cache_clear()
+
+    @patch("lambda_function.time.sleep")
+    @patch("lambda_function.http.request")
+    def test_request_with_retry_retries_transient_status(self, mock_request, mock_sleep):
+        """Test that throttling and server errors are retried with backoff."""
+        mock_request.side_effect = [
+            MagicMock(status=429),
+            MagicMock(status=503),
+            MagicMock(status=200),
+        ]
+
+        response = lf.request_with_retry("GET", "https://example.com", retries=3)
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        for (delay,), _ in mock_sleep.call_args_list:
+            self.assertLessEqual(delay, lf.RETRY_MAX_DELAY_S)
+
+    @patch("lambda_function.time.sleep")
+    @patch("lambda_function.http.request")
+    def test_request_with_retry_reraises_after_last_attempt(self, mock_request, mock_sleep):
+        """Test that connection errors are retried and finally re-raised."""
+        mock_request.side_effect = urllib3.exceptions.NewConnectionError(None, "refused")
+
+        with self.assertRaises(urllib3.exceptions.NewConnectionError):
+            lf.request_with_retry("GET", "https://example.com", retries=2)
+
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch("lambda_function.time.sleep")
+    @patch("lambda_function.http.request")
+    def test_request_with_retry_does_not_repeat_post_after_read_timeout(
+        self, mock_request, mock_sleep
+    ):
+        """Test that a POST the server may have processed is never sent twice."""
+        mock_request.side_effect = urllib3.exceptions.ReadTimeoutError(None, None, "timed out")
+
+        with self.assertRaises(urllib3.exceptions.ReadTimeoutError):
+            lf.request_with_retry("POST", lf.SONIOX_FILES_URL, retries=3, body=b"data")
+
+        mock_request.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @patch("lambda_function.time.sleep")
+    @patch("lambda_function.http.request")
+    def test_request_with_retry_post_only_retries_unsent(self, mock_request, mock_sleep):
+        """Test that a POST is retried on refused connections, 429 and 503 only."""
+        for status in (500, 502, 504):
+            with self.subTest(status=status):
+                mock_request.reset_mock()
+                mock_sleep.reset_mock()
+                mock_request.side_effect = [
+                    urllib3.exceptions.NewConnectionError(None, "refused"),
+                    MagicMock(status=429),
+                    MagicMock(status=503),
+                    MagicMock(status=status),
+                ]
+
+                response = lf.request_with_retry(
+                    "POST", lf.SONIOX_FILES_URL, retries=4, body=b"data"
+                )
+
+                self.assertEqual(response.status, status)
+                self.assertEqual(mock_request.call_count, 4)
+                self.assertEqual(mock_sleep.call_count, 3)
+
+    @patch("lambda_function.time.sleep")
+    @patch("lambda_function.http.request")
+    def test_request_with_retry_does_not_log_url(self, mock_request, _):
+        """Test that retry warnings never include the URL, which holds the bot token."""
+        mock_request.side_effect = [
+            MagicMock(status=503),
+            urllib3.exceptions.ProtocolError(f"failed {lf.TELEGRAM_SEND_URL}"),
+            MagicMock(status=200),
+        ]
+
+        with self.assertLogs(lf.logger, level="WARNING") as logs:
+            lf.request_with_retry("GET", lf.TELEGRAM_SEND_URL, retries=2)
+
+        self.assertEqual(len(logs.output), 2)
+        for line in logs.output:
+            self.assertIn("api.telegram.org", line)
+            self.assertNotIn(lf.TELEGRAM_TOKEN, line)
+
+    @patch("lambda_function.time.sleep")
+    @patch("lambda_function.http.request")
+    def test_request_with_retry_does_not_retry_client_errors(self, mock_request, mock_sleep):
+        """Test that non-transient 4xx responses are returned immediately."""
+        mock_request.return_value = MagicMock(status=401)
+
+        response = lf.request_with_retry("GET", "https://example.com", retries=3)
+
+        self.assertEqual(response.status, 401)
+        mock_request.assert_called_once()
+        mock_sleep.assert_not_called()
 
     @patch("lambda_function.http.request")
     def test_send_reply_success(self, mock_request):
@@ -45,21 +162,96 @@ class TestLambdaFunction(unittest.TestCase):
         self.assertTrue(result)
         url = f"https://api.telegram.org/botfake_telegram_token/sendMessage"
         payload = {"chat_id": self.chat_id, "text": self.reply_message}
-        mock_request.assert_called_once_with(
-            "POST",
-            url,
-            body=json.dumps(payload).encode("utf-8"),
-            headers={"Content-Type": "application/json"},
-        )
+        mock_request.assert_called_once()
+        args, kwargs = mock_request.call_args
+        self.assertEqual(args, ("POST", url))
+        self.assertEqual(json.loads(kwargs["body"]), payload)
+        self.assertEqual(kwargs["headers"], {"Content-Type": "application/json"})
+
+    @patch("lambda_function.http.request")
+    def test_send_reply_escapes_text(self, mock_request):
+        """Test that quotes, newlines and non-ASCII text survive the body template."""
+        mock_request.return_value = MagicMock(status=200)
+        message = 'Транскрипция: "ok"\nline 2 \\ done'
+
+        lf.send_reply(-100123, message)
+
+        body = mock_request.call_args.kwargs["body"]
+        self.assertEqual(json.loads(body), {"chat_id": -100123, "text": message})
+
+    def test_error_snippet_truncates_before_decoding(self):
+        """Test that error bodies are cut to MAX_ERROR_LEN bytes, even mid-character."""
+        raw = "ж".encode("utf-8") * lf.MAX_ERROR_LEN
+        snippet = lf.error_snippet(raw)
+        self.assertEqual(snippet, "ж" * (lf.MAX_ERROR_LEN // 2))
+
+    @patch("lambda_function.urllib3.PoolManager")
+    @patch("lambda_function.http.request")
+    def test_http_pool_is_reused_across_calls(self, mock_request, mock_pool_manager):
+        """Test that requests share the module-level pool instead of creating one."""
+        pool = lf.http
+        mock_request.return_value = MagicMock(status=200)
+
+        lf.send_reply(self.chat_id, self.reply_message)
+        lf.send_reply(self.chat_id, self.reply_message)
+
+        mock_pool_manager.assert_not_called()
+        self.assertIs(lf.http, pool)
+        self.assertEqual(mock_request.call_count, 2)
+
+    def test_json_helpers_fall_back_to_stdlib(self):
+        """Test that the JSON helpers work when orjson is not installed."""
+        try:
+            with patch.dict(sys.modules, {"orjson": None}):
+                importlib.reload(lf)
+                self.assertEqual(json.loads(lf.json_dumps({"text": "ж"})), {"text": "ж"})
+                self.assertEqual(lf.json_loads(b'{"id": "abc"}'), {"id": "abc"})
+        finally:
+            importlib.reload(lf)
 
     @patch("lambda_function.http.request")
     def test_send_reply_failure(self, mock_request):
         """Test message sending failure."""
-        mock_request.side_effect = Exception("Network Error")
+        mock_request.side_effect = urllib3.exceptions.HTTPError("Network Error")
         result = lf.send_reply(self.chat_id, self.reply_message)
         self.assertFalse(result)
 
-    @patch("time.sleep", return_value=None)
+    @patch("lambda_function.http.request")
+    def test_request_data_releases_connection_when_read_fails(self, mock_request):
+        """Test that the pooled connection is released even if the body read fails."""
+        mock_response = MagicMock(status=200)
+        type(mock_response).data = PropertyMock(
+            side_effect=urllib3.exceptions.ProtocolError("Connection broken")
+        )
+        mock_request.return_value = mock_response
+
+        self.assertFalse(lf.send_reply(self.chat_id, self.reply_message))
+        mock_response.release_conn.assert_called_once()
+
+    @patch("lambda_function.http.request")
+    def test_soniox_request_network_error(self, mock_request):
+        """Test that a network failure is reported as status 0, not raised."""
+        mock_request.side_effect = ConnectionResetError("Connection reset")
+        status, data = lf.soniox_request("GET", "https://api.soniox.com/v1/files")
+        self.assertEqual(status, 0)
+        self.assertEqual(data, "Connection reset")
+
+    @patch("lambda_function.http.request")
+    def test_soniox_request_error_status(self, mock_request):
+        """Test that an error response returns its status and truncated body."""
+        mock_request.return_value = MagicMock(status=401, data=b"x" * 500)
+        status, data = lf.soniox_request("GET", "https://api.soniox.com/v1/files")
+        self.assertEqual(status, 401)
+        self.assertEqual(data, "x" * lf.MAX_ERROR_LEN)
+
+    @patch("lambda_function.http.request")
+    def test_send_reply_does_not_mask_programming_errors(self, mock_request):
+        """Test that only network failures are swallowed by send_reply."""
+        mock_request.side_effect = TypeError("bad argument")
+        with self.assertRaises(TypeError):
+            lf.send_reply(self.chat_id, self.reply_message)
+
+    @patch("lambda_function.stop_event.wait", return_value=False)
     @patch("lambda_function.http.request")
     def test_poll_until_complete_success(self, mock_request, _):
         """Test polling succeeds when status becomes 'completed'."""
@@ -78,7 +270,7 @@ class TestLambdaFunction(unittest.TestCase):
         self.assertEqual(result, "completed")
         self.assertEqual(mock_request.call_count, 2)
 
-    @patch("time.sleep", return_value=None)
+    @patch("lambda_function.stop_event.wait", return_value=False)
     @patch("lambda_function.http.request")
     def test_poll_until_complete_error(self, mock_request, _):
         """Test polling when transcription results in an error."""
@@ -92,19 +284,115 @@ class TestLambdaFunction(unittest.TestCase):
         result = lf.poll_until_complete(self.transcription_id)
         self.assertEqual(result, "Bad audio")
 
-    @patch("time.sleep", return_value=None)
-    @patch("lambda_function.http.request")
-    def test_poll_until_complete_timeout(self, mock_request, _):
+    @patch("lambda_function.stop_event.wait", return_value=False)
+    def test_poll_until_complete_timeout(self, _):
         """Test polling timeout after MAX_POLL_RETRIES."""
         mock_response_pending = MagicMock()
         mock_response_pending.status = 200
         mock_response_pending.data = json.dumps({"status": "pending"}).encode("utf-8")
+        # A plain function with a counter instead of a MagicMock, so polls
+        # aren't recorded in a call history
+        polls = 0
+
+        def fake_request(*args, **kwargs):
+            nonlocal polls
+            polls += 1
+            return mock_response_pending
+
+        with patch.object(lf.http, "request", fake_request):
+            result = lf.poll_until_complete(self.transcription_id)
+        self.assertEqual(result, "Transcription timed out")
+        self.assertEqual(polls, lf.MAX_POLL_RETRIES)
+
+    @patch("lambda_function.random.uniform", return_value=0)
+    @patch("lambda_function.stop_event.wait", return_value=False)
+    @patch("lambda_function.http.request")
+    def test_poll_until_complete_backoff(self, mock_request, mock_sleep, _):
+        """Test that poll delays grow exponentially up to the cap."""
+        mock_response_pending = MagicMock()
+        mock_response_pending.status = 200
+        mock_response_pending.data = json.dumps({"status": "pending"}).encode("utf-8")
         mock_request.return_value = mock_response_pending
 
-        result = lf.poll_until_complete(self.transcription_id)
+        lf.poll_until_complete(self.transcription_id)
+
+        delays = [c.args[0] for c in mock_sleep.call_args_list]
+        # No pointless sleep after the final poll
+        self.assertEqual(len(delays), lf.MAX_POLL_RETRIES - 1)
+        self.assertAlmostEqual(delays[0], lf.POLL_INITIAL_DELAY_S)
+        self.assertAlmostEqual(delays[1], lf.POLL_INITIAL_DELAY_S * lf.POLL_BACKOFF_FACTOR)
+        self.assertEqual(delays[-1], lf.POLL_MAX_DELAY_S)
+        self.assertEqual(delays, sorted(delays))
+
+    @patch("lambda_function.stop_event.wait", return_value=False)
+    @patch("lambda_function.http.request")
+    def test_poll_until_complete_deadline(self, mock_request, mock_sleep):
+        """Test polling stops once the wall-clock deadline has passed."""
+        mock_response_pending = MagicMock()
+        mock_response_pending.status = 200
+        mock_response_pending.data = json.dumps({"status": "pending"}).encode("utf-8")
+        mock_request.return_value = mock_response_pending
+        # Start at t=0, then the first deadline check is already past it
+        clock = iter([0.0, lf.POLL_TIMEOUT_S + 1])
+
+        with patch("lambda_function.time.monotonic", side_effect=lambda: next(clock)):
+            result = lf.poll_until_complete(self.transcription_id)
+
         self.assertEqual(result, "Transcription timed out")
+        self.assertEqual(mock_request.call_count, 1)
+        mock_sleep.assert_not_called()
+
+    @patch("lambda_function.stop_event.wait", return_value=False)
+    @patch("lambda_function.http.request")
+    def test_poll_until_complete_bounds_each_request(self, mock_request, _):
+        """Test that polls aren't retried and each one must finish before the deadline."""
+        mock_response_pending = MagicMock()
+        mock_response_pending.status = 200
+        mock_response_pending.data = json.dumps({"status": "pending"}).encode("utf-8")
+        # A stalled poll fails once, is polled again, then the transcript is done
+        mock_response_completed = MagicMock()
+        mock_response_completed.status = 200
+        mock_response_completed.data = json.dumps({"status": "completed"}).encode("utf-8")
+        mock_request.side_effect = [
+            urllib3.exceptions.ReadTimeoutError(None, None, "timed out"),
+            mock_response_pending,
+            mock_response_completed,
+        ]
+
+        with patch.object(lf, "MAX_REQUEST_RETRIES", 3):
+            result = lf.poll_until_complete(self.transcription_id)
+
+        self.assertEqual(result, "completed")
+        self.assertEqual(mock_request.call_count, 3)
+        for c in mock_request.call_args_list:
+            self.assertLessEqual(c.kwargs["timeout"].total, lf.POLL_TIMEOUT_S)
+
+    @patch("lambda_function.stop_event.wait", return_value=False)
+    @patch("lambda_function.http.request")
+    def test_poll_until_complete_reports_persistent_failure(self, mock_request, _):
+        """Test that polling that never gets a status reports the failure."""
+        mock_request.side_effect = urllib3.exceptions.ProtocolError("Connection reset")
+
+        result = lf.poll_until_complete(self.transcription_id)
+
+        self.assertEqual(result, "Failed to get transcription status")
         self.assertEqual(mock_request.call_count, lf.MAX_POLL_RETRIES)
 
+    @patch("lambda_function.http.request")
+    def test_poll_until_complete_canceled(self, mock_request):
+        """Test that setting stop_event ends polling without waiting out the delay."""
+        mock_response_pending = MagicMock()
+        mock_response_pending.status = 200
+        mock_response_pending.data = json.dumps({"status": "pending"}).encode("utf-8")
+        mock_request.return_value = mock_response_pending
+        lf.handle_sigterm(None, None)
+        self.addCleanup(lf.stop_event.clear)
+
+        result = lf.poll_until_complete(self.transcription_id)
+
+        self.assertEqual(result, "Transcription canceled")
+        self.assertEqual(mock_request.call_count, 1)
+
     @patch("lambda_function.http.request")
     def test_get_file_success(self, mock_request):
         """Test successfully getting a file from Telegram."""
@@ -128,10 +416,64 @@ class TestLambdaFunction(unittest.TestCase):
         mock_request.assert_has_calls(
             [
                 call("GET", f"https://api.telegram.org/botfake_telegram_token/getFile?file_id={self.file_id}"),
-                call("GET", f"https://api.telegram.org/file/botfake_telegram_token/{remote_path}"),
+                call(
+                    "GET",
+                    f"https://api.telegram.org/file/botfake_telegram_token/{remote_path}",
+                    preload_content=True,
+                ),
             ]
         )
 
+    @patch("lambda_function.http.request")
+    def test_get_file_stream(self, mock_request):
+        """Test that a streamed download returns the unread response."""
+        mock_response_path = MagicMock()
+        mock_response_path.status = 200
+        mock_response_path.data = json.dumps(
+            {"result": {"file_path": "path/to/file.ogg"}}
+        ).encode("utf-8")
+        mock_response_content = MagicMock()
+        mock_response_content.status = 200
+        mock_request.side_effect = [mock_response_path, mock_response_content]
+
+        status, content = lf.get_file(self.file_id, stream=True)
+
+        self.assertEqual(status, 200)
+        self.assertIs(content, mock_response_content)
+        self.assertFalse(mock_request.call_args.kwargs["preload_content"])
+        mock_response_content.release_conn.assert_not_called()
+
+    @patch("lambda_function.http.request")
+    def test_get_file_reuses_cached_file_path(self, mock_request):
+        """Test that repeat downloads of a file_id skip the getFile call."""
+        mock_response_path = MagicMock(status=200)
+        mock_response_path.data = json.dumps(
+            {"result": {"file_path": "voice/file.oga"}}
+        ).encode("utf-8")
+        mock_response_content = MagicMock(status=200, data=self.file_content)
+        mock_request.side_effect = [
+            mock_response_path,
+            mock_response_content,
+            mock_response_content,
+        ]
+
+        self.assertEqual(lf.get_file(self.file_id), (200, self.file_content))
+        self.assertEqual(lf.get_file(self.file_id), (200, self.file_content))
+
+        urls = [c.args[1] for c in mock_request.call_args_list]
+        self.assertEqual(urls.count(lf.TELEGRAM_GETFILE_URL_FMT.format(self.file_id)), 1)
+        self.assertEqual(urls.count(lf.TELEGRAM_FILE_URL_FMT.format("voice/file.oga")), 2)
+
+    @patch("lambda_function.http.request")
+    def test_get_file_path_failure_is_not_cached(self, mock_request):
+        """Test that a failed getFile lookup is retried on the next download."""
+        mock_request.return_value = MagicMock(status=404, data=b"Not Found")
+
+        lf.get_file(self.file_id)
+        lf.get_file(self.file_id)
+
+        self.assertEqual(mock_request.call_count, 2)
+
     @patch("lambda_function.http.request")
     def test_get_file_path_fails(self, mock_request):
         """Test failure when getting file path from Telegram."""
@@ -167,13 +509,13 @@ class TestLambdaFunction(unittest.TestCase):
         self.assertEqual(content, b"Server Error")
 
     @patch("lambda_function.poll_until_complete")
-    @patch("lambda_function.encode_multipart_formdata")
+    @patch("lambda_function.encode_multipart_file")
     @patch("lambda_function.http.request")
     def test_transcribe_success_and_cleanup(
         self, mock_request, mock_encode, mock_poll
     ):
         """Test successful transcription and resource cleanup."""
-        mock_encode.return_value = (b"form-data", "multipart/form-data")
+        mock_encode.return_value = ([b"form-data"], {"Content-Type": "multipart/form-data"})
         mock_poll.return_value = "completed"
         transcript_text = "Hello world."
 
@@ -191,22 +533,103 @@ class TestLambdaFunction(unittest.TestCase):
         ]
 
         result = lf.transcribe(self.file_content, self.file_type)
+        lf.wait_for_cleanup()
 
         self.assertEqual(result, f"Transcription: {transcript_text}")
-        mock_encode.assert_called_once_with({"file": ("file.dat", self.file_content, self.file_type)})
+        mock_encode.assert_called_once_with(self.file_content, self.file_type)
         mock_poll.assert_called_once_with(self.transcription_id)
-        
+        start_body = json.loads(mock_request.call_args_list[1].kwargs["body"])
+        self.assertEqual(
+            start_body,
+            {
+                "file_id": self.soniox_file_id,
+                "model": "stt-async-preview",
+                "language_hints": ["ru", "uk", "es", "en"],
+            },
+        )
+
         self.assertEqual(mock_request.call_count, 5)
-        delete_calls = [c for c in mock_request.call_args_list if c.args[0] == "DELETE"]
-        self.assertEqual(len(delete_calls), 2)
-        self.assertIn(f"transcriptions/{self.transcription_id}", delete_calls[0].args[1])
-        self.assertIn(f"files/{self.soniox_file_id}", delete_calls[1].args[1])
+        # Cleanup DELETEs run concurrently, so their order is not guaranteed
+        delete_urls = [c.args[1] for c in mock_request.call_args_list if c.args[0] == "DELETE"]
+        self.assertCountEqual(
+            delete_urls,
+            [
+                f"https://api.soniox.com/v1/transcriptions/{self.transcription_id}",
+                f"https://api.soniox.com/v1/files/{self.soniox_file_id}",
+            ],
+        )
+
+    @patch("lambda_function.http.request")
+    def test_delete_resource_failure_is_swallowed(self, mock_request):
+        """Test that a failed cleanup DELETE is logged rather than raised."""
+        mock_request.side_effect = urllib3.exceptions.HTTPError("Network Error")
+        url = f"https://api.soniox.com/v1/files/{self.soniox_file_id}"
+        lf.delete_resource(url, f"file {self.soniox_file_id}")
+        mock_request.assert_called_once_with("DELETE", url, headers=lf.soniox_headers)
+
+    def test_encode_multipart_file_matches_urllib3(self):
+        """Test the hand-rolled encoder produces the same body as urllib3's."""
+        from urllib3.filepost import encode_multipart_formdata
+
+        with patch("lambda_function.choose_boundary", return_value="b0undary"):
+            chunks, headers = lf.encode_multipart_file(self.file_content, self.file_type)
+        expected, content_type = encode_multipart_formdata(
+            {"file": ("file.dat", self.file_content, self.file_type)}, boundary="b0undary"
+        )
+
+        body = b"".join(chunks)
+        self.assertEqual(body, expected)
+        self.assertEqual(headers["Content-Type"], content_type)
+        self.assertEqual(headers["Content-Length"], str(len(expected)))
+        # The file content is passed through as-is, not copied
+        self.assertTrue(any(chunk is self.file_content for chunk in chunks))
+
+    @patch("lambda_function.poll_until_complete")
+    @patch("lambda_function.http.request")
+    def test_transcribe_streams_upload(self, mock_request, mock_poll):
+        """Test that a stream is uploaded in chunks with a computed length."""
+        mock_poll.return_value = "completed"
+        stream = urllib3.HTTPResponse(
+            body=io.BytesIO(self.file_content),
+            headers={"Content-Length": str(len(self.file_content))},
+            preload_content=False,
+        )
+        uploaded = []
+
+        def fake_request(method, url, body=None, headers=None):
+            if url.endswith("/files"):
+                uploaded.append((b"".join(body), headers))
+                return MagicMock(status=200, data=json.dumps({"id": self.soniox_file_id}).encode())
+            if url.endswith("/transcriptions"):
+                return MagicMock(status=200, data=json.dumps({"id": self.transcription_id}).encode())
+            if url.endswith("/transcript"):
+                return MagicMock(status=200, data=json.dumps({"text": "Hi"}).encode())
+            return MagicMock(status=204)
+
+        mock_request.side_effect = fake_request
+
+        result = lf.transcribe(stream, self.file_type)
+        lf.wait_for_cleanup()
+
+        self.assertEqual(result, "Transcription: Hi")
+        body, headers = uploaded[0]
+        self.assertIn(self.file_content, body)
+        self.assertEqual(int(headers["Content-Length"]), len(body))
+        self.assertTrue(headers["Content-Type"].startswith("multipart/form-data; boundary="))
+
+    def test_encode_multipart_file_plain_stream_is_chunked(self):
+        """Test that a stream of unknown size is sent without a Content-Length."""
+        chunks, headers = lf.encode_multipart_file(io.BytesIO(self.file_content), self.file_type)
+
+        self.assertNotIn("Content-Length", headers)
+        self.assertIn(self.file_content, b"".join(chunks))
 
     @patch("lambda_function.http.request")
     def test_transcribe_upload_fails(self, mock_request):
         """Test transcription failure at file upload stage."""
         mock_request.return_value = MagicMock(status=500, data=b"Upload error")
         result = lf.transcribe(self.file_content, self.file_type)
+        lf.wait_for_cleanup()
         self.assertTrue(result.startswith("File upload failed"))
         # Ensure no cleanup calls were made if upload fails
         self.assertEqual(mock_request.call_count, 1)
@@ -220,6 +643,7 @@ class TestLambdaFunction(unittest.TestCase):
         mock_request.side_effect = [mock_upload_resp, mock_start_fail_resp, mock_delete_file_resp]
 
         result = lf.transcribe(self.file_content, self.file_type)
+        lf.wait_for_cleanup()
 
         self.assertTrue(result.startswith("Transcription start failed"))
         self.assertEqual(mock_request.call_count, 3)
@@ -236,11 +660,32 @@ class TestLambdaFunction(unittest.TestCase):
         mock_poll.return_value = "Polling error"
 
         result = lf.transcribe(self.file_content, self.file_type)
+        lf.wait_for_cleanup()
 
         self.assertEqual(result, "Transcription failed: Polling error")
         self.assertEqual(mock_request.call_count, 4)
-        delete_calls = [c for c in mock_request.call_args_list if c.args[0] == "DELETE"]
-        self.assertEqual(len(delete_calls), 2)
+        delete_urls = [c.args[1] for c in mock_request.call_args_list if c.args[0] == "DELETE"]
+        self.assertCountEqual(
+            delete_urls,
+            [
+                f"https://api.soniox.com/v1/transcriptions/{self.transcription_id}",
+                f"https://api.soniox.com/v1/files/{self.soniox_file_id}",
+            ],
+        )
+
+    @patch("lambda_function.http.request")
+    def test_cleanup_deletes_run_concurrently(self, mock_request):
+        """Test that both cleanup DELETEs are in flight at the same time."""
+        # Each DELETE blocks until the other one arrives; run serially, the
+        # barrier would time out and break
+        barrier = threading.Barrier(2, timeout=2)
+        mock_request.side_effect = lambda *args, **kwargs: barrier.wait()
+
+        lf.cleanup_transcription(self.transcription_id, self.soniox_file_id)
+        lf.wait_for_cleanup()
+
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertFalse(barrier.broken)
 
     @patch("lambda_function.handle_media_message")
     @patch("lambda_function.send_reply")
@@ -260,6 +705,213 @@ class TestLambdaFunction(unittest.TestCase):
         mock_send_reply.assert_called_with(self.chat_id, self.reply_message)
         self.assertEqual(response["statusCode"], 200)
 
+    @patch("lambda_function.handle_media_message")
+    @patch("lambda_function.send_reply")
+    def test_lambda_handler_waits_for_cleanup_after_reply(
+        self, mock_send_reply, mock_handle_media
+    ):
+        """Test that background cleanup is awaited only after replying."""
+        order = []
+        mock_send_reply.side_effect = lambda *_: order.append("reply") or True
+        mock_handle_media.return_value = self.reply_message
+        message_data = {
+            "chat": {"id": self.chat_id},
+            "from": {"username": self.username},
+            "voice": {"file_id": self.file_id},
+        }
+        event = {"body": json.dumps({"message": message_data})}
+
+        with patch("lambda_function.wait_for_cleanup") as mock_wait:
+            mock_wait.side_effect = lambda: order.append("cleanup")
+            lf.lambda_handler(event, None)
+
+        self.assertEqual(order, ["reply", "cleanup"])
+
+    @patch("lambda_function.handle_media_message")
+    @patch("lambda_function.send_reply")
+    def test_lambda_handler_enqueues_media_when_queue_configured(
+        self, mock_send_reply, mock_handle_media
+    ):
+        """Test that media messages are handed to SQS instead of transcribed inline."""
+        message_data = {
+            "chat": {"id": self.chat_id},
+            "from": {"username": self.username},
+            "voice": {"file_id": self.file_id},
+        }
+        event = {"body": json.dumps({"message": message_data})}
+        mock_sqs = MagicMock()
+
+        with patch.object(lf, "QUEUE_URL", "https://sqs/queue"), patch.object(
+            lf, "sqs_client", mock_sqs
+        ):
+            response = lf.lambda_handler(event, None)
+
+        self.assertEqual(response["statusCode"], 200)
+        mock_sqs.send_message.assert_called_once_with(
+            QueueUrl="https://sqs/queue", MessageBody=event["body"]
+        )
+        mock_handle_media.assert_not_called()
+        mock_send_reply.assert_not_called()
+
+    @patch("lambda_function.send_reply")
+    def test_lambda_handler_answers_unsupported_messages_inline(self, mock_send_reply):
+        """Test that stickers, photos etc. are not queued when QUEUE_URL is set."""
+        message_data = {
+            "chat": {"id": self.chat_id},
+            "from": {"username": self.username},
+            "sticker": {"file_id": self.file_id},
+        }
+        event = {"body": json.dumps({"message": message_data})}
+        mock_sqs = MagicMock()
+
+        with patch.object(lf, "QUEUE_URL", "https://sqs/queue"), patch.object(
+            lf, "sqs_client", mock_sqs
+        ):
+            response = lf.lambda_handler(event, None)
+
+        self.assertEqual(response["statusCode"], 200)
+        mock_sqs.send_message.assert_not_called()
+        mock_send_reply.assert_called_once()
+
+    @patch("lambda_function.handle_media_message")
+    @patch("lambda_function.send_reply")
+    def test_worker_handler_transcribes_queued_messages(
+        self, mock_send_reply, mock_handle_media
+    ):
+        """Test that the SQS worker transcribes and replies to each record."""
+        mock_handle_media.return_value = self.reply_message
+        message_data = {
+            "chat": {"id": self.chat_id},
+            "from": {"username": self.username},
+            "voice": {"file_id": self.file_id},
+        }
+        event = {"Records": [{"body": json.dumps({"message": message_data})}]}
+
+        lf.worker_handler(event, None)
+
+        mock_handle_media.assert_called_once_with(message_data)
+        mock_send_reply.assert_called_once_with(self.chat_id, self.reply_message)
+
+    @patch("lambda_function.soniox_request")
+    def test_transcribe_with_callback_registers_webhook(self, mock_soniox):
+        """Test that callback mode registers the webhook and skips polling."""
+        mock_soniox.side_effect = [
+            (200, {"id": self.soniox_file_id}),
+            (201, {"id": self.transcription_id}),
+        ]
+        with patch.object(lf, "COMPLETION_WEBHOOK_URL", "https://fn.url/"), patch.object(
+            lf, "SONIOX_WEBHOOK_SECRET", "s3cret"
+        ), patch("lambda_function.poll_until_complete") as mock_poll:
+            result = lf.transcribe_with_callback(
+                self.file_content, self.file_type, self.chat_id, "uniq"
+            )
+
+        self.assertEqual(result, "Transcribing, the text will follow shortly.")
+        mock_poll.assert_not_called()
+        start_body = json.loads(mock_soniox.call_args_list[1].args[2])
+        self.assertEqual(
+            start_body["webhook_url"],
+            f"https://fn.url/?source=soniox&chat_id={self.chat_id}&fuid=uniq",
+        )
+        self.assertEqual(start_body["webhook_auth_header_name"], lf.WEBHOOK_AUTH_HEADER)
+        self.assertEqual(start_body["webhook_auth_header_value"], "s3cret")
+
+    @patch("lambda_function.cleanup_transcription")
+    @patch("lambda_function.get_transcript")
+    @patch("lambda_function.soniox_request")
+    @patch("lambda_function.send_reply")
+    def test_lambda_handler_soniox_callback(
+        self, mock_send_reply, mock_soniox, mock_get_transcript, mock_cleanup
+    ):
+        """Test that a Soniox completion callback replies and cleans up."""
+        mock_soniox.return_value = (200, {"file_id": self.soniox_file_id})
+        mock_get_transcript.return_value = "Transcription: Hello"
+        event = {
+            "headers": {"x-webhook-secret": "s3cret"},
+            "queryStringParameters": {"source": "soniox", "chat_id": str(self.chat_id)},
+            "body": json.dumps({"id": self.transcription_id, "status": "completed"}),
+        }
+
+        with patch.object(lf, "SONIOX_WEBHOOK_SECRET", "s3cret"):
+            response = lf.lambda_handler(event, None)
+
+        self.assertEqual(response["statusCode"], 200)
+        mock_send_reply.assert_called_once_with(self.chat_id, "Transcription: Hello")
+        mock_cleanup.assert_called_once_with(self.transcription_id, self.soniox_file_id)
+
+    @patch("lambda_function.send_reply")
+    def test_lambda_handler_soniox_callback_bad_secret(self, mock_send_reply):
+        """Test that a callback without the shared secret is rejected."""
+        for secret in ("wrong", "секрет"):
+            with self.subTest(secret=secret):
+                event = {
+                    "headers": {"x-webhook-secret": secret},
+                    "queryStringParameters": {"source": "soniox", "chat_id": str(self.chat_id)},
+                    "body": json.dumps({"id": self.transcription_id, "status": "completed"}),
+                }
+
+                with patch.object(lf, "SONIOX_WEBHOOK_SECRET", "s3cret"):
+                    response = lf.lambda_handler(event, None)
+
+                self.assertEqual(response["statusCode"], 403)
+        mock_send_reply.assert_not_called()
+
+    @patch("lambda_function.send_reply")
+    def test_executor_is_reused_across_invocations(self, mock_send_reply):
+        """Test that the worker pool is module-level, not created per call."""
+        event = {
+            "body": json.dumps(
+                {
+                    "message": {
+                        "chat": {"id": self.chat_id},
+                        "from": {"username": self.username},
+                        "text": "hello",
+                    }
+                }
+            )
+        }
+        executor_id = id(lf.executor)
+
+        lf.lambda_handler(event, None)
+        lf.lambda_handler(event, None)
+
+        self.assertEqual(id(lf.executor), executor_id)
+        self.assertEqual(mock_send_reply.call_count, 2)
+
+    @patch("lambda_function.handle_media_message")
+    @patch("lambda_function.send_reply")
+    def test_worker_handler_processes_batch_concurrently(
+        self, mock_send_reply, mock_handle_media
+    ):
+        """Test that every record of an SQS batch is answered, in parallel."""
+        # Each transcription waits for the other; serially the barrier would break
+        barrier = threading.Barrier(2, timeout=2)
+        mock_handle_media.side_effect = lambda message: (
+            barrier.wait(),
+            f"Transcription for {message['chat']['id']}",
+        )[1]
+        records = [
+            {
+                "body": json.dumps(
+                    {
+                        "message": {
+                            "chat": {"id": chat_id},
+                            "from": {"username": self.username},
+                            "voice": {"file_id": self.file_id},
+                        }
+                    }
+                )
+            }
+            for chat_id in (1, 2)
+        ]
+
+        lf.worker_handler({"Records": records}, None)
+
+        mock_send_reply.assert_has_calls(
+            [call(1, "Transcription for 1"), call(2, "Transcription for 2")], any_order=True
+        )
+        self.assertFalse(barrier.broken)
+
     @patch("lambda_function.send_reply")
     def test_lambda_handler_unauthorized(self, mock_send_reply):
         """Test lambda_handler with an unauthorized user."""
@@ -281,6 +933,37 @@ class TestLambdaFunction(unittest.TestCase):
         self.assertEqual(response["statusCode"], 200)
         self.assertEqual(response["body"], "unauthorized_user is unauthorized")
 
+    @patch("lambda_function.reply_to_message", return_value="ok")
+    @patch("lambda_function.send_reply")
+    def test_lambda_handler_allows_every_listed_user(self, mock_send_reply, mock_reply):
+        """Test that each user in a multi-user ALLOW_LIST is authorized."""
+        with patch.object(lf, "ALLOW_LIST", frozenset({"alice", "bob", self.username})):
+            for username in ("alice", "bob", self.username):
+                message = {
+                    "chat": {"id": self.chat_id},
+                    "from": {"username": username},
+                    "text": "hello",
+                }
+                response = lf.lambda_handler({"body": json.dumps({"message": message})}, None)
+                self.assertEqual(response["statusCode"], 200)
+                mock_reply.assert_called_with(message)
+            # Prefixes of allowed names must not match
+            message["from"]["username"] = "ali"
+            response = lf.lambda_handler({"body": json.dumps({"message": message})}, None)
+
+        self.assertEqual(response["body"], "ali is unauthorized")
+        self.assertEqual(mock_reply.call_count, 3)
+        mock_send_reply.assert_called_once_with(
+            self.chat_id, "Sorry, user 'ali' is not authorized."
+        )
+
+    def test_allow_list_ignores_whitespace_and_empty_entries(self):
+        """Test that ALLOW_LIST is parsed into a set of trimmed usernames."""
+        self.addCleanup(importlib.reload, lf)
+        with patch.dict(os.environ, {"ALLOW_LIST": " alice, bob ,,"}):
+            importlib.reload(lf)
+        self.assertEqual(lf.ALLOW_LIST, frozenset({"alice", "bob"}))
+
     def test_lambda_handler_invalid_json(self):
         """Test lambda_handler with invalid JSON body."""
         event = {"body": "this is not json"}
@@ -298,10 +981,64 @@ class TestLambdaFunction(unittest.TestCase):
         }
         result = lf.handle_media_message(message)
 
-        mock_get_file.assert_called_with(self.file_id)
+        mock_get_file.assert_called_with(self.file_id, stream=True)
         mock_transcribe.assert_called_with(self.file_content, "audio/ogg")
         self.assertEqual(result, "Transcription successful")
 
+    @patch("lambda_function.transcribe")
+    @patch("lambda_function.get_file")
+    def test_handle_media_message_failed_upload_leaves_pool_usable(
+        self, mock_get_file, mock_transcribe
+    ):
+        """Test that a partly read download doesn't put a dirty socket in the pool."""
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "4096")
+                self.end_headers()
+                self.wfile.write(b"\0" * 4096)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+        mock_get_file.side_effect = lambda *_, **__: (
+            200,
+            lf.http.request("GET", f"{base_url}/file", preload_content=False),
+        )
+
+        def failing_upload(stream, _):
+            stream.read(1024)  # The upload dies after sending a little
+            return "File upload failed"
+
+        mock_transcribe.side_effect = failing_upload
+        message = {"voice": {"file_id": self.file_id}}
+
+        self.assertEqual(lf.handle_media_message(message), "File upload failed")
+        with patch.object(lf, "TELEGRAM_SEND_URL", f"{base_url}/sendMessage"):
+            self.assertTrue(lf.send_reply(self.chat_id, "File upload failed"))
+
+    @patch("lambda_function.get_file")
+    def test_handle_media_message_no_media(self, mock_get_file):
+        """Test handle_media_message returns None when there is no media."""
+        self.assertIsNone(lf.handle_media_message({"sticker": {"file_id": self.file_id}}))
+        mock_get_file.assert_not_called()
+
     @patch("lambda_function.get_file")
     def test_handle_media_message_download_fail(self, mock_get_file):
         """Test handle_media_message when file download fails."""
@@ -310,6 +1047,69 @@ class TestLambdaFunction(unittest.TestCase):
         result = lf.handle_media_message(message)
         self.assertTrue(result.startswith("File download failed"))
 
+    def test_import_does_not_load_boto3(self):
+        """Test that importing the module with the cache and queue on leaves boto3 unloaded."""
+        # Any attempt to import boto3/botocore fails the child process, so
+        # this holds whether or not boto3 is installed
+        code = (
+            "import sys\n"
+            "class Guard:\n"
+            "    def find_spec(self, name, path=None, target=None):\n"
+            "        if name.partition('.')[0] in ('boto3', 'botocore'):\n"
+            "            sys.exit(1)\n"
+            "sys.meta_path.insert(0, Guard())\n"
+            "import lambda_function\n"
+        )
+        env = dict(os.environ, CACHE_TABLE="transcripts", QUEUE_URL="https://sqs/queue")
+        result = subprocess.run(
+            [sys.executable, "-c", code], cwd=os.path.dirname(lf.__file__), env=env
+        )
+        self.assertEqual(result.returncode, 0)
+
+    def test_get_cache_table_is_memoized(self):
+        """Test that the DynamoDB table is created on first use, then reused."""
+        mock_boto3 = MagicMock()
+        with patch.dict(sys.modules, {"boto3": mock_boto3}), patch.object(
+            lf, "CACHE_TABLE", "transcripts"
+        ), patch.object(lf, "cache_table", None):
+            table = lf.get_cache_table()
+            self.assertIs(lf.get_cache_table(), table)
+
+        mock_boto3.resource.assert_called_once_with("dynamodb")
+        mock_boto3.resource.return_value.Table.assert_called_once_with("transcripts")
+
+    @patch("lambda_function.get_file")
+    def test_handle_media_message_cache_hit(self, mock_get_file):
+        """Test that a cached transcript skips download and transcription."""
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {"Item": {"text": "Transcription: cached"}}
+        message = {"voice": {"file_id": self.file_id, "file_unique_id": "uniq"}}
+
+        with patch.object(lf, "cache_table", mock_table):
+            result = lf.handle_media_message(message)
+
+        self.assertEqual(result, "Transcription: cached")
+        mock_table.get_item.assert_called_once_with(Key={"fid": "uniq"})
+        mock_get_file.assert_not_called()
+
+    @patch("lambda_function.get_file")
+    @patch("lambda_function.transcribe")
+    def test_handle_media_message_cache_miss_stores(self, mock_transcribe, mock_get_file):
+        """Test that a successful transcription is written to the cache."""
+        mock_table = MagicMock()
+        mock_table.get_item.return_value = {}
+        mock_get_file.return_value = (200, self.file_content)
+        mock_transcribe.return_value = "Transcription: fresh"
+        message = {"voice": {"file_id": self.file_id, "file_unique_id": "uniq"}}
+
+        with patch.object(lf, "cache_table", mock_table):
+            result = lf.handle_media_message(message)
+
+        self.assertEqual(result, "Transcription: fresh")
+        item = mock_table.put_item.call_args.kwargs["Item"]
+        self.assertEqual(item["fid"], "uniq")
+        self.assertEqual(item["text"], "Transcription: fresh")
+
 
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
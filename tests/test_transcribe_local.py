@@ -1,4 +1,5 @@
 import os
+import subprocess
 import sys
 import unittest
 import importlib
@@ -9,8 +10,22 @@ import transcribe_local as tl
 
 
 class TestTranscribeLocal(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        """Patch environment variables and reload the module once for all tests."""
+        cls.env_patcher = patch.dict(os.environ, {"SONIOX_TOKEN": "fake_soniox_token"})
+        cls.env_patcher.start()
+        # Reload module to apply patched env vars
+        if "lambda_function" in sys.modules:
+            importlib.reload(sys.modules["lambda_function"])
+
+    @classmethod
+    def tearDownClass(cls):
+        """Restore the environment."""
+        cls.env_patcher.stop()
+
     def setUp(self):
-        """Set up test files and patch environment variables."""
+        """Set up test files."""
         self.test_dir = Path("test_data")
         self.test_dir.mkdir(exist_ok=True)
         self.input_file = self.test_dir / "audio.mp3"
@@ -18,13 +33,6 @@ class TestTranscribeLocal(unittest.TestCase):
         # Use write_bytes for binary content simulation
         self.input_file.write_bytes(b"fake_audio_content")
 
-        self.env_patcher = patch.dict(os.environ, {"SONIOX_TOKEN": "fake_soniox_token"})
-        self.env_patcher.start()
-        # Reload module to apply patched env vars
-        if "lambda_function" in sys.modules:
-            importlib.reload(sys.modules["lambda_function"])
-        self.addCleanup(self.env_patcher.stop)
-
     def tearDown(self):
         """Clean up created files."""
         if self.input_file.exists():
@@ -48,7 +56,14 @@ class TestTranscribeLocal(unittest.TestCase):
         self.assertIn(tl.detect_mime_type(Path("test.wav")), ["audio/wav", "audio/x-wav"])
         self.assertEqual(tl.detect_mime_type(Path("unknown")), "application/octet-stream")
 
-    @patch("transcribe_local.transcribe")
+    @patch("mimetypes.guess_type")
+    def test_detect_mime_type_common_media_skips_database(self, mock_guess_type):
+        """Test that common media extensions are resolved without mimetypes."""
+        self.assertEqual(tl.detect_mime_type(Path("voice.OGG")), "audio/ogg")
+        self.assertEqual(tl.detect_mime_type(Path("memo.m4a")), "audio/mp4")
+        mock_guess_type.assert_not_called()
+
+    @patch("lambda_function.transcribe")
     @patch("sys.exit")
     def test_main_success(self, mock_exit, mock_transcribe):
         """Test the main function for a successful transcription."""
@@ -65,7 +80,30 @@ class TestTranscribeLocal(unittest.TestCase):
         self.assertEqual(self.output_file.read_text(encoding="utf-8"), transcript)
         mock_exit.assert_not_called()
 
-    @patch("transcribe_local.transcribe")
+    @patch("lambda_function.transcribe")
+    @patch("sys.exit")
+    def test_main_maps_large_file(self, mock_exit, mock_transcribe):
+        """Test that large files are passed to transcribe as a memory-mapped view."""
+        content = b"x" * tl.MMAP_THRESHOLD_BYTES
+        self.input_file.write_bytes(content)
+        received = []
+
+        def fake_transcribe(file_content, mime_type):
+            received.append((type(file_content), bytes(file_content)))
+            return "Transcription: long"
+
+        mock_transcribe.side_effect = fake_transcribe
+
+        with patch.object(
+            sys, "argv", ["prog_name", str(self.input_file), "-o", str(self.output_file)]
+        ):
+            tl.main()
+
+        self.assertEqual(received, [(memoryview, content)])
+        self.assertEqual(self.output_file.read_text(encoding="utf-8"), "long")
+        mock_exit.assert_not_called()
+
+    @patch("lambda_function.transcribe")
     @patch("sys.exit")
     def test_main_transcription_fails(self, mock_exit, mock_transcribe):
         """Test the main function when transcription returns an error."""
@@ -92,8 +130,19 @@ class TestTranscribeLocal(unittest.TestCase):
                 tl.main()
         mock_exit.assert_called_once_with(1)
 
+    def test_import_does_not_load_lambda_function(self):
+        """Test that importing the CLI defers loading lambda_function and urllib3."""
+        code = (
+            "import sys, transcribe_local; "
+            "sys.exit('lambda_function' in sys.modules or 'urllib3' in sys.modules)"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], cwd=Path(tl.__file__).parent
+        )
+        self.assertEqual(result.returncode, 0)
+
     @patch("pathlib.Path.write_text")
-    @patch("transcribe_local.transcribe")
+    @patch("lambda_function.transcribe")
     @patch("sys.exit")
     def test_main_output_write_fails(self, mock_exit, mock_transcribe, mock_write):
         """Test the main function when writing the output file fails."""
@@ -7,8 +7,8 @@ function defined in `lambda_function.py`. The script:
 2. Optionally accepts an output text file path; if omitted, it will derive one
    from the input file name with a `.txt` extension.
 3. Detects the MIME type of the input file for more accurate transcription.
-4. Reads the file content, invokes `transcribe`, and writes the resulting text
-   to the output file.
+4. Reads the file content (memory-mapping it when large), invokes
+   `transcribe`, and writes the resulting text to the output file.
 
 Environment variables expected:
 - SONIOX_TOKEN : Your Soniox API token.
@@ -17,18 +17,37 @@ Environment variables expected:
 import argparse
 import logging
 import mimetypes
+import mmap
 import sys
+from contextlib import ExitStack
 from pathlib import Path
 
-from lambda_function import transcribe  # type: ignore
-
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
+# MIME types of the audio/video formats this tool is typically used with
+EXTENSION_MIME_TYPES = {
+    ".flac": "audio/flac",
+    ".m4a": "audio/mp4",
+    ".mp3": "audio/mpeg",
+    ".mp4": "video/mp4",
+    ".oga": "audio/ogg",
+    ".ogg": "audio/ogg",
+    ".wav": "audio/wav",
+    ".webm": "video/webm",
+}
+
+# Files at least this large are memory-mapped instead of read into memory
+MMAP_THRESHOLD_BYTES = 64 * 1024
+
 
 def detect_mime_type(file_path: Path) -> str:
     """Return the best-guess MIME type for the given file path."""
+    # Common media types are answered without loading the system MIME database
+    mime_type = EXTENSION_MIME_TYPES.get(file_path.suffix.lower())
+    if mime_type:
+        return mime_type
     mime_type, _ = mimetypes.guess_type(str(file_path))
     return mime_type or "application/octet-stream"
 
@@ -69,15 +88,26 @@ def main() -> None:
     mime_type = detect_mime_type(input_path)
     logger.info("Detected MIME type: %s", mime_type)
 
-    # Read file content
-    try:
-        file_bytes = input_path.read_bytes()
-    except Exception as e:
-        logger.error("Failed to read input file: %s", e)
-        sys.exit(1)
+    # Imported only now: it pulls in urllib3, which `--help` and bad paths
+    # don't need
+    from lambda_function import transcribe  # type: ignore
+
+    # Read small files into memory; memory-map larger ones so the upload is
+    # sent straight from the page cache without copying the file
+    with ExitStack() as stack:
+        try:
+            if input_path.stat().st_size < MMAP_THRESHOLD_BYTES:
+                file_content = input_path.read_bytes()
+            else:
+                f = stack.enter_context(input_path.open("rb"))
+                mm = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                file_content = stack.enter_context(memoryview(mm))
+        except Exception as e:
+            logger.error("Failed to read input file: %s", e)
+            sys.exit(1)
 
-    logger.info("Starting transcription for '%s'…", input_path.name)
-    result = transcribe(file_bytes, mime_type)
+        logger.info("Starting transcription for '%s'…", input_path.name)
+        result = transcribe(file_content, mime_type)
 
     # `transcribe` returns either "Transcription: <text>" or an error message.
     if result.startswith("Transcription:"):